@@ -1,16 +1,21 @@
 from __future__ import annotations
 
+import hashlib
 from datetime import datetime, timezone
 from typing import Any, Dict, List
 
 from zoneinfo import ZoneInfo
 
 from bson import ObjectId
+from bson.errors import InvalidId
 from fastapi import Depends, FastAPI, HTTPException, Query, Header, status
 from fastapi.middleware.cors import CORSMiddleware
+from pymongo.errors import DuplicateKeyError
 
 from .db import ensure_indexes, get_db
 from .models import (
+    STATUS_ENDED,
+    STATUS_SCHEDULED,
     ChatOut,
     DeliveryOut,
     SavedCampaignCreate,
@@ -59,6 +64,50 @@ def _local_input_to_utc(dt: datetime | None, tz_name: str) -> datetime | None:
     return dt.astimezone(timezone.utc)
 
 
+# Fields that make two scheduled messages "the same" for create idempotency.
+_IDEMPOTENCY_FIELDS = (
+    "title",
+    "description",
+    "imageUrls",
+    "targetsMode",
+    "targetChatIds",
+    "parseMode",
+    "disablePreview",
+    "scheduleType",
+    "runAt",
+    "nextRunAt",
+    "cron",
+    "endAt",
+    "tz",
+    "enabled",
+)
+_BUCKETED_FIELDS = ("runAt", "nextRunAt")
+
+
+def _idempotency_key(doc: Dict[str, Any]) -> str:
+    """SHA-256 over a message's content and schedule slot.
+
+    A double-submitted create produces the same key, so the unique index on
+    idempotencyKey turns the second insert into a no-op. runAt and nextRunAt
+    (the slot for cron messages) are bucketed to the minute so resubmits a few
+    seconds apart still collide.
+    """
+    h = hashlib.sha256()
+    for field in _IDEMPOTENCY_FIELDS:
+        value = doc.get(field)
+        if field in _BUCKETED_FIELDS and value is not None:
+            value = value.replace(second=0, microsecond=0)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif field == "targetChatIds":
+            value = sorted(value or [])
+        h.update(field.encode("utf-8"))
+        h.update(b"=")
+        h.update(repr(value).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
 app = FastAPI(title="Telegram Automation API", version="1.0.0")
 
 app.add_middleware(
@@ -71,14 +120,22 @@ app.add_middleware(
 
 
 def _id_str(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # Docs come straight from a cursor and aren't reused, so convert in place
+    # instead of copying every key into a new dict.
     if doc is None:
         return doc
-    d = dict(doc)
-    if "_id" in d and isinstance(d["_id"], ObjectId):
-        d["_id"] = str(d["_id"])
-    if "scheduledId" in d and isinstance(d["scheduledId"], ObjectId):
-        d["scheduledId"] = str(d["scheduledId"])
-    return d
+    if isinstance(doc.get("_id"), ObjectId):
+        doc["_id"] = str(doc["_id"])
+    if isinstance(doc.get("scheduledId"), ObjectId):
+        doc["scheduledId"] = str(doc["scheduledId"])
+    return doc
+
+
+def _message_oid(message_id: str) -> ObjectId:
+    try:
+        return ObjectId(message_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid message id")
 
 
 @app.on_event("startup")
@@ -112,12 +169,14 @@ async def list_messages(limit: int = 50, skip: int = 0):
     db = get_db()
     # Safety: ignore legacy docs that don't match our API schema (pre-refactor).
     q = {"title": {"$exists": True}}
+    # pymongo accepts a negative limit (single batch) but not a negative batch_size.
     cur = (
         db[settings.SCHEDULED_MESSAGES_COLLECTION]
         .find(q)
         .sort("createdAt", -1)
         .skip(skip)
         .limit(limit)
+        .batch_size(abs(limit))
     )
     out = []
     async for doc in cur:
@@ -165,15 +224,28 @@ async def create_message(payload: ScheduledMessageCreate):
         "endAt": end_at_utc,
         "tz": payload.tz,
         "enabled": bool(payload.enabled) and (next_run is not None),
-        "status": "scheduled" if next_run is not None else "ended",
+        "status": STATUS_SCHEDULED if next_run is not None else STATUS_ENDED,
         "nextRunAt": next_run,
         "lastRunAt": None,
         "createdAt": now,
         "updatedAt": now,
     }
-    res = await db[settings.SCHEDULED_MESSAGES_COLLECTION].insert_one(doc)
-    saved = await db[settings.SCHEDULED_MESSAGES_COLLECTION].find_one({"_id": res.inserted_id})
-    return _id_str(saved)
+    doc["idempotencyKey"] = _idempotency_key(doc)
+    coll = db[settings.SCHEDULED_MESSAGES_COLLECTION]
+    for _ in range(2):
+        try:
+            res = await coll.insert_one(doc)
+        except DuplicateKeyError:
+            # Same content for the same slot already exists: return it instead of a copy.
+            saved = await coll.find_one({"idempotencyKey": doc["idempotencyKey"], "enabled": True})
+            if saved is not None:
+                return _id_str(saved)
+            # The conflicting row finished, was edited or deleted in between; insert again.
+            doc.pop("_id", None)
+            continue
+        saved = await coll.find_one({"_id": res.inserted_id})
+        return _id_str(saved)
+    raise HTTPException(status_code=409, detail="An identical message is being created concurrently; retry")
 
 
 @app.patch(
@@ -183,10 +255,7 @@ async def create_message(payload: ScheduledMessageCreate):
 )
 async def update_message(message_id: str, payload: ScheduledMessageUpdate):
     db = get_db()
-    try:
-        oid = ObjectId(message_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid message id")
+    oid = _message_oid(message_id)
 
     existing = await db[settings.SCHEDULED_MESSAGES_COLLECTION].find_one({"_id": oid})
     if not existing:
@@ -222,11 +291,15 @@ async def update_message(message_id: str, payload: ScheduledMessageUpdate):
         # If we have an endAt and there are no more runs, mark as ended.
         if next_run is None:
             update["enabled"] = False
-            update["status"] = "ended"
+            update["status"] = STATUS_ENDED
 
     update["updatedAt"] = datetime.now(timezone.utc)
 
-    await db[settings.SCHEDULED_MESSAGES_COLLECTION].update_one({"_id": oid}, {"$set": update})
+    ops: Dict[str, Any] = {"$set": update}
+    # Once edited, the doc no longer matches the create request its key came from.
+    if any(k in update for k in _IDEMPOTENCY_FIELDS):
+        ops["$unset"] = {"idempotencyKey": ""}
+    await db[settings.SCHEDULED_MESSAGES_COLLECTION].update_one({"_id": oid}, ops)
     saved = await db[settings.SCHEDULED_MESSAGES_COLLECTION].find_one({"_id": oid})
     return _id_str(saved)
 
@@ -238,15 +311,17 @@ async def update_message(message_id: str, payload: ScheduledMessageUpdate):
 )
 async def run_message_now(message_id: str):
     db = get_db()
-    try:
-        oid = ObjectId(message_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid message id")
+    oid = _message_oid(message_id)
 
     now = datetime.now(timezone.utc)
+    # Re-arming a finished message puts it back under the idempotency index;
+    # drop its key so it can't collide with a newer identical create.
     await db[settings.SCHEDULED_MESSAGES_COLLECTION].update_one(
         {"_id": oid},
-        {"$set": {"nextRunAt": now, "status": "scheduled", "enabled": True, "updatedAt": now}},
+        {
+            "$set": {"nextRunAt": now, "status": STATUS_SCHEDULED, "enabled": True, "updatedAt": now},
+            "$unset": {"idempotencyKey": ""},
+        },
     )
     saved = await db[settings.SCHEDULED_MESSAGES_COLLECTION].find_one({"_id": oid})
     if not saved:
@@ -260,10 +335,7 @@ async def run_message_now(message_id: str):
 )
 async def delete_message(message_id: str):
     db = get_db()
-    try:
-        oid = ObjectId(message_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid message id")
+    oid = _message_oid(message_id)
     await db[settings.SCHEDULED_MESSAGES_COLLECTION].delete_one({"_id": oid})
     return {"ok": True}
 
@@ -277,15 +349,13 @@ async def delete_message(message_id: str):
 )
 async def list_deliveries(message_id: str, limit: int = 100):
     db = get_db()
-    try:
-        oid = ObjectId(message_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid message id")
+    oid = _message_oid(message_id)
     cur = (
         db[settings.DELIVERIES_COLLECTION]
         .find({"scheduledId": oid})
         .sort("sentAt", -1)
         .limit(limit)
+        .batch_size(abs(limit))
     )
     out = []
     async for doc in cur:
@@ -302,7 +372,7 @@ async def list_deliveries(message_id: str, limit: int = 100):
 )
 async def list_campaigns(limit: int = 100):
     db = get_db()
-    cur = db[settings.SAVED_CAMPAIGNS_COLLECTION].find({}).sort("updatedAt", -1).limit(limit)
+    cur = db[settings.SAVED_CAMPAIGNS_COLLECTION].find({}).sort("updatedAt", -1).limit(limit).batch_size(abs(limit))
     out = []
     async for doc in cur:
         out.append(_id_str(doc))
@@ -4,9 +4,10 @@ import logging
 from typing import Optional
 
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pymongo import ASCENDING
+from pymongo import ASCENDING, DESCENDING
 from pymongo.errors import OperationFailure
 
+from .models import STATUS_CODES
 from .settings import settings
 
 logger = logging.getLogger("tg_automation.db")
@@ -57,6 +58,14 @@ def _same_index_spec(existing: dict, *, key: list[tuple[str, int]], unique: bool
     return existing_pfe == pfe
 
 
+async def _migrate_status_codes(scheduled) -> None:
+    """Rewrite legacy string statuses to their integer codes (idempotent)."""
+    for name, code in STATUS_CODES.items():
+        res = await scheduled.update_many({"status": name}, {"$set": {"status": code}})
+        if res.modified_count:
+            logger.info("Migrated %d scheduled messages from status %r to %d.", res.modified_count, name, code)
+
+
 async def ensure_indexes() -> None:
     db = get_db()
 
@@ -73,10 +82,26 @@ async def ensure_indexes() -> None:
         sparse=True,
         name="normalizedTitle_1",
     )
+    # Worker target lookup for "all" broadcasts
+    await chats.create_index([("isActive", ASCENDING), ("chatId", ASCENDING)], name="isActive_1_chatId_1")
+    # /api/chats: equality on isActive, ordered by title
+    await chats.create_index([("isActive", ASCENDING), ("title", ASCENDING)], name="isActive_1_title_1")
 
     # ---- Scheduled messages ----
+    await _migrate_status_codes(scheduled)
     await scheduled.create_index([("enabled", ASCENDING)], name="enabled_1")
     await scheduled.create_index([("status", ASCENDING), ("nextRunAt", ASCENDING)], name="due_1")
+    await scheduled.create_index([("createdAt", DESCENDING)], name="createdAt_-1")
+    # Create idempotency, only among messages that will still run: the worker
+    # and the API clear `enabled` whenever a message is done, ended, failed or
+    # switched off, so those don't block a new identical create. Docs without
+    # a key (legacy or edited) are not indexed either.
+    await scheduled.create_index(
+        [("idempotencyKey", ASCENDING)],
+        unique=True,
+        name="idempotencyKey_active_uniq",
+        partialFilterExpression={"idempotencyKey": {"$type": "string"}, "enabled": True},
+    )
 
     # ---- Deliveries (cron-safe idempotency) ----
     # We want uniqueness per run: (scheduledId, chatId, runAt)
@@ -151,6 +176,8 @@ async def ensure_indexes() -> None:
     # Helpful secondary indexes
     await deliveries.create_index([("scheduledId", ASCENDING), ("runAt", ASCENDING)], name="scheduledId_runAt_1")
     await deliveries.create_index([("chatId", ASCENDING), ("runAt", ASCENDING)], name="chatId_runAt_1")
+    await deliveries.create_index([("scheduledId", ASCENDING), ("sentAt", DESCENDING)], name="scheduledId_1_sentAt_-1")
 
     # ---- Saved campaigns ----
     await saved.create_index([("code", ASCENDING)], unique=True, name="code_1")
+    await saved.create_index([("updatedAt", DESCENDING)], name="updatedAt_-1")
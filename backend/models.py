@@ -3,12 +3,31 @@ from __future__ import annotations
 from datetime import datetime
 from typing import List, Optional, Literal
 
-from pydantic import BaseModel, Field, HttpUrl, model_validator
+from pydantic import BaseModel, Field, HttpUrl, field_validator, model_validator
 
 
 ScheduleType = Literal["once", "cron"]
 TargetsMode = Literal["all", "explicit"]
 
+# Scheduled-message status as stored in MongoDB. The API keeps the names;
+# the worker defines the same codes, so keep both in sync.
+STATUS_SCHEDULED = 0
+STATUS_PROCESSING = 1
+STATUS_DONE = 2
+STATUS_ENDED = 3
+STATUS_ERROR = 4
+STATUS_NO_TARGETS = 5
+
+STATUS_CODES = {
+    "scheduled": STATUS_SCHEDULED,
+    "processing": STATUS_PROCESSING,
+    "done": STATUS_DONE,
+    "ended": STATUS_ENDED,
+    "error": STATUS_ERROR,
+    "no_targets": STATUS_NO_TARGETS,
+}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
 
 class ChatOut(BaseModel):
     id: str = Field(alias="_id")
@@ -103,6 +122,13 @@ class ScheduledMessageOut(BaseModel):
     createdAt: Optional[datetime] = None
     updatedAt: Optional[datetime] = None
 
+    @field_validator("status", mode="before")
+    @classmethod
+    def _status_name(cls, v):
+        if isinstance(v, int):
+            return STATUS_NAMES.get(v, str(v))
+        return v
+
 
 class DeliveryOut(BaseModel):
     id: str = Field(alias="_id")
@@ -1,10 +1,17 @@
 from __future__ import annotations
 
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
 
+def default_image_cache_dir() -> str:
+    """Per-user cache location; never a shared, predictable /tmp path."""
+    base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "tg_worker", "images")
+
+
 @dataclass(frozen=True)
 class Settings:
     # Telegram (user session)
@@ -25,13 +32,38 @@ class Settings:
     TZ_NAME: str
 
     # Control
+    # Minimum gap between two sends to the *same* chat. Before per-chat
+    # throttling this was a single gap between any two sends (~2.9 msg/s
+    # account-wide); that cap is now ACCOUNT_SENDS_PER_SECOND.
     MIN_DELAY_SECONDS: float = 0.35
+    # Account-wide send rate. This is a user session, not a bot: keep it low.
+    ACCOUNT_SENDS_PER_SECOND: float = 2.5
+    BROADCAST_CONCURRENCY: int = 16
     SCHEDULER_POLL_SECONDS: float = 5.0
+    # With a working change stream the scheduler sleeps until the next known
+    # fire, but never longer than this (so expired claims still get reaped)
+    SCHEDULER_MAX_IDLE_SECONDS: float = 60.0
+    # Keep claiming due messages for up to this long per tick before yielding
+    SCHEDULER_TICK_BUDGET_SECONDS: float = 30.0
+    CLAIM_LEASE_MINUTES: int = 15
+    MONGO_MAX_POOL_SIZE: int = 50
+    MONGO_MIN_POOL_SIZE: int = 5
     DIALOG_SYNC_EVERY_MINUTES: int = 30
+    # Downloaded/re-encoded images; must be owned by the worker and not
+    # writable by group/other, since its contents get broadcast.
+    IMAGE_CACHE_DIR: str = field(default_factory=default_image_cache_dir)
+    # Log full tracebacks for every failed delivery (otherwise one summary per minute)
+    DEBUG: bool = False
 
     @property
     def tz(self) -> ZoneInfo:
-        return ZoneInfo(self.TZ_NAME)
+        return get_zone(self.TZ_NAME)
+
+
+@lru_cache(maxsize=None)
+def get_zone(name: str) -> ZoneInfo:
+    """Memoized ZoneInfo lookup; zone names come from a small fixed set."""
+    return ZoneInfo(name)
 
 
 def load_settings() -> Settings:
@@ -54,4 +86,8 @@ def load_settings() -> Settings:
         DELIVERIES_COLLECTION=os.getenv("DELIVERIES_COLLECTION", "deliveries"),
 
         TZ_NAME=os.getenv("TZ_NAME", "America/Los_Angeles"),
+
+        ACCOUNT_SENDS_PER_SECOND=float(os.getenv("ACCOUNT_SENDS_PER_SECOND", "2.5")),
+        IMAGE_CACHE_DIR=os.getenv("IMAGE_CACHE_DIR") or default_image_cache_dir(),
+        DEBUG=os.getenv("DEBUG", "").lower() in ("1", "true", "yes"),
     )
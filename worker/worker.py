@@ -1,29 +1,55 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import hashlib
 import html
 import logging
 import os
-import re
+import shutil
+import socket
+import stat
 import tempfile
+import time
+import urllib.request
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set
 
 from croniter import croniter
 from dotenv import load_dotenv
-from pymongo import MongoClient, ASCENDING
-from pymongo.errors import DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from telethon import TelegramClient, events
 from telethon.errors import FloodWaitError
 from telethon.sessions import StringSession
 from telethon.tl.types import PeerChat, PeerChannel, PeerUser
 from zoneinfo import ZoneInfo
 
+# Optional image helpers: without aiohttp downloads use urllib, without
+# aiofiles they are written with blocking writes, without Pillow images are
+# sent exactly as downloaded.
 try:
-    from .settings import load_settings
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import aiofiles
 except ImportError:
-    from settings import load_settings
+    aiofiles = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+else:
+    # Decompression-bomb guard (Pillow refuses images above 2x this).
+    Image.MAX_IMAGE_PIXELS = 40_000_000
+
+try:
+    from .settings import Settings, default_image_cache_dir, get_zone, load_settings
+except ImportError:
+    from settings import Settings, default_image_cache_dir, get_zone, load_settings
 
 log = logging.getLogger("tg_worker")
 logging.basicConfig(
@@ -32,27 +58,50 @@ logging.basicConfig(
 )
 logging.getLogger("telethon").setLevel(logging.INFO)
 
+# Scheduled-message status codes; must match backend/models.py.
+STATUS_SCHEDULED = 0
+STATUS_PROCESSING = 1
+STATUS_DONE = 2
+STATUS_ENDED = 3
+STATUS_ERROR = 4
+STATUS_NO_TARGETS = 5
+
+_LEGACY_STATUS_NAMES = {
+    "scheduled": STATUS_SCHEDULED,
+    "processing": STATUS_PROCESSING,
+    "done": STATUS_DONE,
+    "ended": STATUS_ENDED,
+    "error": STATUS_ERROR,
+    "no_targets": STATUS_NO_TARGETS,
+}
+
 
 def esc(s: str) -> str:
-    return html.escape(str(s), quote=True)
+    return html.escape(s if type(s) is str else str(s), quote=True)
 
 
 def normalize_title(title: Optional[str]) -> Optional[str]:
     if not title:
         return None
-    t = re.sub(r"\s+", " ", title.strip()).lower()
+    # str.split() collapses whitespace runs exactly like re.sub(r"\s+", " ", ...)
+    t = " ".join(title.split()).lower()
     return t or None
 
 
+# Peer types are final TL classes, so an exact-type lookup replaces isinstance.
+_PEER_ID_EXTRACTORS = {
+    PeerUser: lambda p: p.user_id,
+    PeerChat: lambda p: -p.chat_id,
+    PeerChannel: lambda p: -p.channel_id,
+}
+
+
 def canonical_chat_id(entity) -> Optional[int]:
     if entity is None:
         return None
-    if isinstance(entity, PeerUser):
-        return entity.user_id
-    if isinstance(entity, PeerChat):
-        return -entity.chat_id
-    if isinstance(entity, PeerChannel):
-        return -entity.channel_id
+    extract = _PEER_ID_EXTRACTORS.get(type(entity))
+    if extract is not None:
+        return extract(entity)
     if hasattr(entity, "id") and hasattr(entity, "channel_id"):
         return -int(entity.id)
     if hasattr(entity, "id"):
@@ -60,6 +109,14 @@ def canonical_chat_id(entity) -> Optional[int]:
     return None
 
 
+@functools.lru_cache(maxsize=1)
+def _ts_for_minute(minute: int) -> datetime:
+    """UTC datetime for a minute bucket; seen-at stamps don't need more precision."""
+    return datetime.fromtimestamp(minute * 60, tz=timezone.utc)
+
+
+# Cron messages repeat the same caption every run.
+@functools.lru_cache(maxsize=256)
 def build_caption(title: str, description: str) -> str:
     title = (title or "").strip()
     description = (description or "").strip()
@@ -68,17 +125,91 @@ def build_caption(title: str, description: str) -> str:
     return f"<b>{esc(title)}</b>"
 
 
-_last_send_time: Optional[datetime] = None
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens/s up to `capacity`.
 
+    take() reserves a token immediately (the balance may go negative) and
+    returns how long the caller must wait for it, so concurrent callers queue
+    up in order without a lock.
+
+    The rate adapts: on_throttle() halves it (down to max_rate / 16) and blocks
+    the bucket for the server's retry-after; each on_success() adds back a
+    tenth of max_rate. Nothing refills during a block, so callers that queue
+    while blocked are spaced out at `rate` after it ends instead of all
+    firing the moment it lifts.
+    """
+
+    __slots__ = ("tokens", "last", "rate", "capacity", "max_rate", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+
+    def take(self) -> float:
+        now = time.monotonic()
+        # Refill accrues from the end of any block, never during it.
+        start = max(now, self.blocked_until)
+        if start > self.last:
+            self.tokens = min(self.capacity, self.tokens + (start - self.last) * self.rate)
+            self.last = start
+        self.tokens -= 1
+        return max(0.0, self.blocked_until - now) + max(0.0, -self.tokens) / self.rate
+
+    def on_success(self) -> None:
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def on_throttle(self, retry_after: float) -> None:
+        now = time.monotonic()
+        # Concurrent senders report the same flood wait; halve once per block.
+        if now >= self.blocked_until:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.last = max(self.last, self.blocked_until)
+
+
+# Telegram flood limits are per peer, plus an account-wide limit; main()
+# resizes the account bucket from settings at startup.
+_chat_buckets: Dict[int, TokenBucket] = {}
+
+
+def set_account_rate(sends_per_second: float) -> None:
+    global _account_bucket
+    _account_bucket = TokenBucket(sends_per_second, max(1.0, sends_per_second))
 
-async def throttle(min_delay_seconds: float) -> None:
-    global _last_send_time
-    now = datetime.now(timezone.utc)
-    if _last_send_time is not None:
-        delta = (now - _last_send_time).total_seconds()
-        if delta < min_delay_seconds:
-            await asyncio.sleep(min_delay_seconds - delta)
-    _last_send_time = datetime.now(timezone.utc)
+
+set_account_rate(Settings.ACCOUNT_SENDS_PER_SECOND)
+
+
+def _chat_bucket(chat_id: int, min_delay_seconds: float) -> TokenBucket:
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = TokenBucket(1.0 / max(min_delay_seconds, 0.001), 1.0)
+    return bucket
+
+
+def _note_flood_wait(bucket: TokenBucket, retry_after: float) -> None:
+    # User-session flood waits are usually account-wide, so every sender backs off.
+    bucket.on_throttle(retry_after)
+    _account_bucket.on_throttle(retry_after)
+
+
+def _note_sent(bucket: TokenBucket) -> None:
+    bucket.on_success()
+    _account_bucket.on_success()
+
+
+async def throttle(chat_id: int, min_delay_seconds: float) -> None:
+    """Wait for both this chat's bucket (one send per min_delay_seconds) and
+    the account bucket; sends to different chats don't wait on each other."""
+    wait = max(_chat_bucket(chat_id, min_delay_seconds).take(), _account_bucket.take())
+    if wait > 0:
+        await asyncio.sleep(wait)
 
 
 async def send_text_safe(
@@ -89,79 +220,307 @@ async def send_text_safe(
     parse_mode: Optional[str] = None,
     link_preview: bool = False,
     min_delay_seconds: float = 0.35,
+    peer: Any = None,
 ) -> List[int]:
     if not text:
         return []
+    target = peer if peer is not None else chat_id
+    bucket = _chat_bucket(chat_id, min_delay_seconds)
     try:
-        await throttle(min_delay_seconds)
-        msg = await client.send_message(chat_id, text, parse_mode=parse_mode, link_preview=link_preview)
-        return [msg.id]
+        await throttle(chat_id, min_delay_seconds)
+        msg = await client.send_message(target, text, parse_mode=parse_mode, link_preview=link_preview)
     except FloodWaitError as e:
         log.warning("FloodWait while sending to %s: %s", chat_id, e)
-        await asyncio.sleep(e.seconds + 1)
-        msg = await client.send_message(chat_id, text, parse_mode=parse_mode, link_preview=link_preview)
-        return [msg.id]
+        _note_flood_wait(bucket, e.seconds + 1)
+        await throttle(chat_id, min_delay_seconds)
+        msg = await client.send_message(target, text, parse_mode=parse_mode, link_preview=link_preview)
+    _note_sent(bucket)
+    return [msg.id]
 
 
-async def _download_one(url: str, dest_dir: str) -> Optional[str]:
-    import aiohttp
-    import urllib.request
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+_ALLOWED_EXTS = frozenset({".jpg", ".jpeg", ".png", ".webp", ".bmp"})
+
+# Downloads and re-encodes persist here between runs, so a cron message with
+# the same imageUrls doesn't fetch or convert them again. A file's mtime is
+# when it was written (re-encodes are keyed on their source's mtime, and
+# downloads older than _IMAGE_CACHE_MAX_AGE_SECONDS are fetched again in case
+# the image behind the URL changed); its atime is bumped on each hit, and the
+# least recently used files are evicted past _IMAGE_CACHE_MAX_FILES.
+# main() points this at settings.IMAGE_CACHE_DIR via set_image_cache_dir().
+_image_cache_dir: Optional[str] = None
+_IMAGE_CACHE_MAX_FILES = 512
+_IMAGE_CACHE_MAX_AGE_SECONDS = 24 * 60 * 60
+
+# One pooled session for all downloads so repeat hosts reuse keep-alive connections.
+_http_session: Optional["aiohttp.ClientSession"] = None
 
+
+def _is_private_dir(path: str) -> bool:
+    """True if path is a real directory we own that only we can write to."""
+    st = os.lstat(path)
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def set_image_cache_dir(path: str) -> str:
+    """Create (0700) and vet the image cache directory.
+
+    Cache names are derivable from the URL, so a directory other users can
+    write to would let them plant images that get broadcast. If path fails the
+    check, a fresh private temp dir is used instead (no reuse across restarts).
+    """
+    global _image_cache_dir
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        ok = _is_private_dir(path)
+    except OSError:
+        ok = False
+    if not ok:
+        fallback = tempfile.mkdtemp(prefix="tg_img_cache_")
+        log.warning("Image cache dir %s is not private to this user; using %s", path, fallback)
+        path = fallback
+    _image_cache_dir = path
+    return path
+
+
+def _get_image_cache_dir() -> str:
+    if _image_cache_dir is None:
+        return set_image_cache_dir(default_image_cache_dir())
+    return _image_cache_dir
+
+
+async def _get_http_session() -> "aiohttp.ClientSession":
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(limit=64, limit_per_host=8, keepalive_timeout=75, ttl_dns_cache=300),
+        )
+    return _http_session
+
+
+async def _close_http_session() -> None:
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+
+async def _download_one(url: str, dest_dir: str) -> Optional[str]:
     if os.path.exists(url):
         return url
 
     # derive a filename
-    guess = url.split("?")[0].lower()
-    ext = ".jpg"
-    for e in (".jpg", ".jpeg", ".png", ".webp", ".bmp"):
-        if guess.endswith(e):
-            ext = e
-            break
-    filename = hashlib.sha1(url.encode("utf-8")).hexdigest() + ext
+    ext = os.path.splitext(url.split("?", 1)[0])[1].lower()
+    if ext not in _ALLOWED_EXTS:
+        ext = ".jpg"
+    filename = _cache_name(url) + ext
     path = os.path.join(dest_dir, filename)
+    if _touch_cached(path, max_age=_IMAGE_CACHE_MAX_AGE_SECONDS):
+        return path
 
+    # Write to a unique .part file and rename, so a cached name is always complete.
+    fd, part = tempfile.mkstemp(dir=dest_dir, suffix=".part")
+    os.close(fd)
     try:
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    return None
-                data = await resp.read()
-                with open(path, "wb") as f:
-                    f.write(data)
-        return path
-    except Exception:
+        if aiohttp is not None:
+            try:
+                session = await _get_http_session()
+                async with session.get(url) as resp:
+                    if resp.status != 200:
+                        return None
+                    # stream to disk instead of buffering the whole image in memory
+                    if aiofiles is not None:
+                        async with aiofiles.open(part, "wb") as af:
+                            async for chunk in resp.content.iter_chunked(_DOWNLOAD_CHUNK_SIZE):
+                                await af.write(chunk)
+                    else:
+                        with open(part, "wb") as f:
+                            async for chunk in resp.content.iter_chunked(_DOWNLOAD_CHUNK_SIZE):
+                                f.write(chunk)
+                os.replace(part, path)
+                return path
+            except Exception:
+                pass
+
         # fallback
         try:
-            with urllib.request.urlopen(url, timeout=30) as r:
-                data = r.read()
-            with open(path, "wb") as f:
-                f.write(data)
+            with urllib.request.urlopen(url, timeout=30) as r, open(part, "wb") as f:
+                shutil.copyfileobj(r, f, length=_DOWNLOAD_CHUNK_SIZE)
+            os.replace(part, path)
             return path
         except Exception:
             return None
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
 
 
-def _ensure_photo_jpeg(src_path: str, dest_dir: str) -> str:
+def _cache_name(key: str) -> str:
+    """Filename-safe digest for cache entries (not a security boundary)."""
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _touch_cached(path: str, max_age: Optional[float] = None) -> bool:
+    """True if path is cached (and younger than max_age seconds, if given).
+
+    Only the atime is bumped for LRU eviction; the mtime stays the write time
+    because re-encode keys and the max-age check depend on it.
+    """
     try:
-        from PIL import Image
+        st = os.stat(path)
+        now_ns = time.time_ns()
+        if max_age is not None and now_ns - st.st_mtime_ns > max_age * 1_000_000_000:
+            return False
+        os.utime(path, ns=(now_ns, st.st_mtime_ns))
+        return True
+    except OSError:
+        return False
+
+
+def _evict_image_cache(cache_dir: str, max_files: int) -> None:
+    """Delete the least recently used cache files beyond max_files."""
+    entries = [e for e in os.scandir(cache_dir) if e.is_file() and not e.name.endswith(".part")]
+    if len(entries) <= max_files:
+        return
+    entries.sort(key=lambda e: e.stat().st_atime)
+    for e in entries[: len(entries) - max_files]:
+        try:
+            os.remove(e.path)
+        except OSError:
+            pass
+
+
+# Telegram photo limits: 10 MB, width + height <= 10000, aspect ratio <= 20.
+_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+_PHOTO_MAX_SIDES = 10000
+_PHOTO_MAX_RATIO = 20
+
+
+@functools.lru_cache(maxsize=256)
+def _is_sendable_jpeg(src_path: str, size: int, mtime_ns: int) -> bool:
+    """True if the file is a JPEG Telegram accepts as a photo without re-encoding.
+
+    size/mtime_ns are part of the cache key so a rewritten file is re-checked.
+    """
+    if size > _PHOTO_MAX_BYTES:
+        return False
+    with open(src_path, "rb") as f:
+        if f.read(3) != b"\xff\xd8\xff":
+            return False
+    if Image is None:
+        return True
+    # Image.open only parses the header here; pixel data is not decoded.
+    with Image.open(src_path) as im:
+        w, h = im.size
+        mode = im.mode
+    # CMYK/YCCK JPEGs are valid files but render wrong in Telegram clients.
+    if mode not in ("RGB", "L"):
+        return False
+    if w <= 0 or h <= 0 or w + h > _PHOTO_MAX_SIDES:
+        return False
+    return max(w, h) / min(w, h) <= _PHOTO_MAX_RATIO
+
+
+def _ensure_photo_jpeg(src_path: str, cache_dir: str) -> str:
+    """Return a path Telegram accepts as a photo: the original file, or a
+    re-encoded JPEG in cache_dir (reused while the source is unchanged)."""
+    try:
+        st = os.stat(src_path)
+        if _is_sendable_jpeg(src_path, st.st_size, st.st_mtime_ns):
+            return src_path
     except Exception:
         return src_path
 
+    if Image is None:
+        return src_path
+
+    key = f"{src_path}:{st.st_size}:{st.st_mtime_ns}"
+    out_path = os.path.join(cache_dir, _cache_name(key) + ".jpg")
+    if _touch_cached(out_path):
+        return out_path
+
     try:
         with Image.open(src_path) as im:
-            im.verify()
-        with Image.open(src_path) as im2:
-            if im2.mode not in ("RGB", "L"):
-                im2 = im2.convert("RGB")
-            out_name = hashlib.md5(src_path.encode("utf-8")).hexdigest() + ".jpg"
-            out_path = os.path.join(dest_dir, out_name)
-            im2.save(out_path, "JPEG", quality=90, optimize=True)
-            return out_path
+            im.load()  # full decode; raises on truncated/corrupt files
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            fd, part = tempfile.mkstemp(dir=cache_dir, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    im.save(f, "JPEG", quality=90, optimize=True)
+                os.replace(part, out_path)
+            finally:
+                if os.path.exists(part):
+                    os.remove(part)
+        return out_path
     except Exception:
         return src_path
 
 
+# Strong refs to in-flight cleanup tasks so they aren't garbage-collected mid-run.
+_cleanup_tasks: Set[asyncio.Task] = set()
+
+
+def _schedule_cleanup(cache_dir: str) -> None:
+    """Trim the image cache in a worker thread without delaying the caller."""
+    task = asyncio.create_task(asyncio.to_thread(_evict_image_cache, cache_dir, _IMAGE_CACHE_MAX_FILES))
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
+
+async def _prepare_album(client: TelegramClient, image_urls: List[str]) -> List[Any]:
+    """Download, normalize and upload up to 10 images once.
+
+    Returns the uploaded InputFile handles, which can be re-sent to any number
+    of chats without transferring the bytes again. Empty if nothing downloaded.
+    """
+    cache_dir = _get_image_cache_dir()
+    try:
+        # Downloads run concurrently; the shared connector bounds per-host fan-out.
+        results = await asyncio.gather(*(_download_one(u, cache_dir) for u in image_urls[:10]), return_exceptions=True)
+        local_paths = [p for p in results if isinstance(p, str)]
+        # Re-encode off the event loop.
+        prepared = await asyncio.gather(*(asyncio.to_thread(_ensure_photo_jpeg, p, cache_dir) for p in local_paths))
+        return [await client.upload_file(f) for f in prepared]
+    finally:
+        _schedule_cleanup(cache_dir)
+
+
+async def send_album_safe(
+    client: TelegramClient,
+    chat_id: int,
+    files: List[Any],
+    image_urls: List[str],
+    *,
+    caption: Optional[str],
+    parse_mode: str = "html",
+    min_delay_seconds: float = 0.35,
+    peer: Any = None,
+) -> List[int]:
+    if not files:
+        # fall back to sending links + caption
+        ids: List[int] = []
+        if caption:
+            ids.extend(await send_text_safe(client, chat_id, caption, parse_mode=parse_mode, link_preview=True, min_delay_seconds=min_delay_seconds, peer=peer))
+        for u in image_urls[:10]:
+            ids.extend(await send_text_safe(client, chat_id, u, parse_mode=parse_mode, link_preview=True, min_delay_seconds=min_delay_seconds, peer=peer))
+        return ids
+
+    target = peer if peer is not None else chat_id
+    bucket = _chat_bucket(chat_id, min_delay_seconds)
+    captions = [caption] + [""] * (len(files) - 1) if caption else None
+    try:
+        await throttle(chat_id, min_delay_seconds)
+        result = await client.send_file(target, files, caption=captions, parse_mode=parse_mode, force_document=False)
+    except FloodWaitError as e:
+        _note_flood_wait(bucket, e.seconds + 1)
+        await throttle(chat_id, min_delay_seconds)
+        result = await client.send_file(target, files, caption=captions, parse_mode=parse_mode, force_document=False)
+    _note_sent(bucket)
+    if isinstance(result, list):
+        return [m.id for m in result]
+    return [result.id]
+
+
 async def send_images_safe(
     client: TelegramClient,
     chat_id: int,
@@ -173,53 +532,21 @@ async def send_images_safe(
 ) -> List[int]:
     if not image_urls:
         return []
-    image_urls = image_urls[:10]
+    files = await _prepare_album(client, image_urls)
+    return await send_album_safe(client, chat_id, files, image_urls, caption=caption, parse_mode=parse_mode, min_delay_seconds=min_delay_seconds)
 
-    tmpdir = tempfile.mkdtemp(prefix="tg_album_")
-    local_paths: List[str] = []
-    prepared: List[str] = []
-    try:
-        for u in image_urls:
-            p = await _download_one(u, tmpdir)
-            if p:
-                local_paths.append(p)
-        if not local_paths:
-            # fall back to sending links + caption
-            ids: List[int] = []
-            if caption:
-                ids.extend(await send_text_safe(client, chat_id, caption, parse_mode=parse_mode, link_preview=True, min_delay_seconds=min_delay_seconds))
-            for u in image_urls:
-                ids.extend(await send_text_safe(client, chat_id, u, parse_mode=parse_mode, link_preview=True, min_delay_seconds=min_delay_seconds))
-            return ids
-
-        for p in local_paths:
-            prepared.append(_ensure_photo_jpeg(p, tmpdir))
-
-        captions = [caption] + [""] * (len(prepared) - 1) if caption else None
-        await throttle(min_delay_seconds)
-        result = await client.send_file(chat_id, prepared, caption=captions, parse_mode=parse_mode, force_document=False)
-        if isinstance(result, list):
-            return [m.id for m in result]
-        return [result.id]
-    except FloodWaitError as e:
-        await asyncio.sleep(e.seconds + 1)
-        result = await client.send_file(chat_id, prepared or local_paths, caption=caption, parse_mode=parse_mode, force_document=False)
-        if isinstance(result, list):
-            return [m.id for m in result]
-        return [result.id]
-    finally:
-        try:
-            for p in set(local_paths + prepared):
-                try:
-                    os.remove(p)
-                except Exception:
-                    pass
-            os.rmdir(tmpdir)
-        except Exception:
-            pass
 
+@functools.lru_cache(maxsize=512)
+def _cron_iter(cron: str) -> croniter:
+    """Parsed cron expression, reused across fires.
 
-def compute_next_run_at_utc(doc: Dict[str, Any], tz: ZoneInfo) -> datetime | None:
+    The instance is stateful, so callers must always pass start_time to
+    get_next(); that resets it before computing.
+    """
+    return croniter(cron)
+
+
+def compute_next_run_at_utc(doc: Dict[str, Any], tz: ZoneInfo, now: datetime | None = None) -> datetime | None:
     schedule_type = doc.get("scheduleType", "once")
     end_at = doc.get("endAt")
 
@@ -261,9 +588,8 @@ def compute_next_run_at_utc(doc: Dict[str, Any], tz: ZoneInfo) -> datetime | Non
     if not cron:
         raise ValueError("Missing cron for cron schedule")
 
-    now_local = datetime.now(tz)
-    it = croniter(cron, now_local)
-    next_local = it.get_next(datetime)
+    now_local = now.astimezone(tz) if now is not None else datetime.now(tz)
+    next_local = _cron_iter(cron).get_next(datetime, start_time=now_local)
     if next_local.tzinfo is None:
         next_local = next_local.replace(tzinfo=tz)
     next_utc = next_local.astimezone(timezone.utc)
@@ -272,8 +598,13 @@ def compute_next_run_at_utc(doc: Dict[str, Any], tz: ZoneInfo) -> datetime | Non
     return next_utc
 
 
-def get_db(settings):
-    cli = MongoClient(settings.MONGO_URI)
+async def get_db(settings):
+    """Motor handle; creates indexes and runs startup migrations first."""
+    cli = AsyncIOMotorClient(
+        settings.MONGO_URI,
+        maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+        minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+    )
     db = cli[settings.MONGODB_NAME]
 
     chats = db[settings.CHATS_COLLECTION]
@@ -281,16 +612,18 @@ def get_db(settings):
     scheduled = db[settings.SCHEDULED_MESSAGES_COLLECTION]
 
     # Indexes (safe)
-    chats.create_index([("chatId", ASCENDING)], unique=True, name="chatId_1")
-    chats.create_index([("normalizedTitle", ASCENDING)], unique=True, sparse=True, name="normalizedTitle_1")
+    await chats.create_index([("chatId", ASCENDING)], unique=True, name="chatId_1")
+    await chats.create_index([("normalizedTitle", ASCENDING)], unique=True, sparse=True, name="normalizedTitle_1")
+    # Target lookup for "all" broadcasts: isActive equality, then chatId range.
+    await chats.create_index([("isActive", ASCENDING), ("chatId", ASCENDING)], name="isActive_1_chatId_1")
     # Deliveries: one delivery per (scheduledId, chatId, runAt) so cron can repeat.
-    existing = deliveries.index_information()
+    existing = await deliveries.index_information()
     if "scheduledId_chatId_uniq" in existing:
         try:
-            deliveries.drop_index("scheduledId_chatId_uniq")
+            await deliveries.drop_index("scheduledId_chatId_uniq")
         except Exception:
             pass
-    deliveries.create_index(
+    await deliveries.create_index(
         [("scheduledId", ASCENDING), ("chatId", ASCENDING), ("runAt", ASCENDING)],
         unique=True,
         name="scheduledId_chatId_runAt_uniq",
@@ -299,19 +632,105 @@ def get_db(settings):
             "runAt": {"$type": "date"},
         },
     )
-    deliveries.create_index([("scheduledId", ASCENDING), ("runAt", ASCENDING)], name="scheduledId_runAt_1")
-    scheduled.create_index([("status", ASCENDING), ("nextRunAt", ASCENDING)], name="due_1")
+    await deliveries.create_index([("scheduledId", ASCENDING), ("runAt", ASCENDING)], name="scheduledId_runAt_1")
+    await scheduled.create_index([("status", ASCENDING), ("nextRunAt", ASCENDING)], name="due_1")
+    await normalize_schedule_dates(db, settings)
+    await migrate_status_codes(scheduled)
 
     return db
 
 
+_SCHEDULE_DATE_FIELDS = ("nextRunAt", "runAt", "endAt")
+
+
+async def normalize_schedule_dates(db, settings) -> None:
+    """Store schedule datetimes as BSON dates so the scheduler never parses them.
+
+    Legacy rows holding ISO strings are converted once (unparseable values are
+    left alone), and a moderate-level validator rejects new string values.
+    """
+    scheduled = db[settings.SCHEDULED_MESSAGES_COLLECTION]
+    for field in _SCHEDULE_DATE_FIELDS:
+        res = await scheduled.update_many(
+            {field: {"$type": "string"}},
+            [{"$set": {field: {"$convert": {"input": f"${field}", "to": "date", "onError": f"${field}"}}}}],
+        )
+        if res.modified_count:
+            log.info("Converted %d string %s values to dates.", res.modified_count, field)
+
+    schema = {
+        "bsonType": "object",
+        "properties": {field: {"bsonType": ["date", "null"]} for field in _SCHEDULE_DATE_FIELDS},
+    }
+    try:
+        await db.command(
+            "collMod",
+            settings.SCHEDULED_MESSAGES_COLLECTION,
+            validator={"$jsonSchema": schema},
+            validationLevel="moderate",
+        )
+    except OperationFailure as e:
+        log.warning("Could not install scheduled_messages validator: %s", e)
+
+
+async def migrate_status_codes(scheduled) -> None:
+    """Rewrite legacy string statuses to integer codes (idempotent)."""
+    for name, code in _LEGACY_STATUS_NAMES.items():
+        res = await scheduled.update_many({"status": name}, {"$set": {"status": code}})
+        if res.modified_count:
+            log.info("Migrated %d scheduled messages from status %r to %d.", res.modified_count, name, code)
+
+
+# InputPeer (with access hash) per canonical chat id, filled by the dialog sync
+# so sends don't go through Telethon's entity lookup each time. LRU-bounded.
+_PEER_CACHE_MAX = 10_000
+_peer_cache: "OrderedDict[int, Any]" = OrderedDict()
+
+
+def _cache_peer(chat_id: int, peer: Any) -> None:
+    _peer_cache[chat_id] = peer
+    _peer_cache.move_to_end(chat_id)
+    if len(_peer_cache) > _PEER_CACHE_MAX:
+        _peer_cache.popitem(last=False)
+
+
+async def resolve_peers(client: TelegramClient, chat_ids: List[int]) -> Dict[int, Any]:
+    """InputPeers for chat_ids, resolving cache misses concurrently.
+
+    Ids that can't be resolved map to themselves so the send still gets tried.
+    """
+    peers: Dict[int, Any] = {}
+    missing: List[int] = []
+    for cid in chat_ids:
+        peer = _peer_cache.get(cid)
+        if peer is None:
+            missing.append(cid)
+        else:
+            _peer_cache.move_to_end(cid)
+            peers[cid] = peer
+    if missing:
+        found = await asyncio.gather(*(client.get_input_entity(cid) for cid in missing), return_exceptions=True)
+        for cid, peer in zip(missing, found):
+            if isinstance(peer, Exception):
+                peers[cid] = cid
+            else:
+                _cache_peer(cid, peer)
+                peers[cid] = peer
+    return peers
+
+
 async def sync_dialogs(client: TelegramClient, chats_coll):
     now = datetime.now(timezone.utc)
+    # Titled chats keyed by normalized title (a later dialog with the same
+    # title wins, as it did when each one was upserted in turn), untitled by id.
+    by_norm: Dict[str, Dict[str, Any]] = {}
+    untitled: List[Dict[str, Any]] = []
     async for dlg in client.iter_dialogs():
         ent = dlg.entity
         chat_id = canonical_chat_id(ent)
         if chat_id is None or chat_id >= 0:
             continue
+        _cache_peer(chat_id, dlg.input_entity)
         title = getattr(ent, "title", getattr(ent, "username", None))
         norm = normalize_title(title)
         doc = {
@@ -323,19 +742,28 @@ async def sync_dialogs(client: TelegramClient, chats_coll):
             "firstSeenAt": now,
             "lastSeenAt": now,
         }
-
-        # Prefer de-dupe by title if present
         if norm:
-            existing = chats_coll.find_one({"normalizedTitle": norm})
-            if existing:
-                chats_coll.update_one({"_id": existing["_id"]}, {"$set": {"lastSeenAt": now, "isActive": True, "chatId": chat_id}})
-                continue
+            by_norm[norm] = doc
+        else:
+            untitled.append(doc)
+
+    # Prefer de-dupe by title if present: one query finds every known title.
+    existing: Dict[str, Any] = {}
+    if by_norm:
+        cur = chats_coll.find({"normalizedTitle": {"$in": list(by_norm)}}, {"_id": 1, "normalizedTitle": 1})
+        existing = {d["normalizedTitle"]: d["_id"] async for d in cur}
+
+    ops: List[UpdateOne] = []
+    for norm, doc in by_norm.items():
+        if norm in existing:
+            ops.append(UpdateOne({"_id": existing[norm]}, {"$set": {"lastSeenAt": now, "isActive": True, "chatId": doc["chatId"]}}))
+        else:
+            ops.append(UpdateOne({"chatId": doc["chatId"]}, {"$setOnInsert": doc, "$set": {"lastSeenAt": now, "isActive": True}}, upsert=True))
+    for doc in untitled:
+        ops.append(UpdateOne({"chatId": doc["chatId"]}, {"$setOnInsert": doc, "$set": {"lastSeenAt": now, "isActive": True}}, upsert=True))
 
-        chats_coll.update_one(
-            {"chatId": chat_id},
-            {"$setOnInsert": doc, "$set": {"lastSeenAt": now, "isActive": True}},
-            upsert=True,
-        )
+    if ops:
+        await chats_coll.bulk_write(ops, ordered=False)
 
 
 async def periodic_dialog_sync(client: TelegramClient, chats_coll, minutes: int):
@@ -347,12 +775,35 @@ async def periodic_dialog_sync(client: TelegramClient, chats_coll, minutes: int)
         await asyncio.sleep(minutes * 60)
 
 
+# Delivery failures by exception class since the last summary line.
+_delivery_errors: Counter = Counter()
+
+
+async def periodic_error_summary(seconds: int = 60):
+    while True:
+        await asyncio.sleep(seconds)
+        if _delivery_errors:
+            log.warning("Delivery errors in the last %ds: %s", seconds, _delivery_errors.most_common())
+            _delivery_errors.clear()
+
+
+async def active_target_ids(chats_coll) -> List[int]:
+    """Sorted chat ids of all active groups/channels.
+
+    chatId is unique, and isActive_1_chatId_1 returns it in order without a
+    document fetch (_id excluded), so Mongo hands back a deduped, sorted list.
+    """
+    cur = chats_coll.find({"isActive": True, "chatId": {"$lt": 0}}, {"_id": 0, "chatId": 1}).sort("chatId", ASCENDING)
+    return [d["chatId"] async for d in cur]
+
+
 async def send_scheduled_to_targets(
     client: TelegramClient,
     db,
     settings,
     doc: Dict[str, Any],
     run_at: datetime,
+    now: datetime,
 ) -> None:
     scheduled_coll = db[settings.SCHEDULED_MESSAGES_COLLECTION]
     deliveries_coll = db[settings.DELIVERIES_COLLECTION]
@@ -367,138 +818,372 @@ async def send_scheduled_to_targets(
 
     targets_mode = (doc.get("targetsMode") or "all").lower()
     if targets_mode == "explicit":
-        chat_ids = sorted({int(x) for x in (doc.get("targetChatIds") or []) if int(x) < 0})
+        # int() once per id: legacy/hand-edited docs may hold numeric strings
+        chat_ids = sorted({cid for cid in map(int, doc.get("targetChatIds") or []) if cid < 0})
     else:
-        chat_ids = [
-            int(d["chatId"])
-            for d in chats_coll.find({"isActive": True, "chatId": {"$lt": 0}}, {"chatId": 1})
-        ]
-        chat_ids = sorted(set(chat_ids))
+        chat_ids = await active_target_ids(chats_coll)
 
     if not chat_ids:
-        scheduled_coll.update_one({"_id": scheduled_id}, {"$set": {"status": "no_targets", "updatedAt": datetime.now(timezone.utc)}})
+        await scheduled_coll.update_one({"_id": scheduled_id}, {"$set": {"status": STATUS_NO_TARGETS, "updatedAt": now}})
         return
 
     caption = build_caption(title, description)
+    image_urls = [str(u) for u in image_urls]
+    # Uploaded once by the first chat that needs it, then reused for the fan-out.
+    album: Optional[List[Any]] = None
+
+    # Claim every (scheduledId, chatId, runAt) up front; the unique index rejects
+    # rows that an earlier attempt already owns, so those chats are skipped
+    # unless that attempt died holding them (claim older than the lease).
+    lease = timedelta(minutes=settings.CLAIM_LEASE_MINUTES)
+    claimed = await claim_deliveries(
+        deliveries_coll,
+        [
+            {"scheduledId": scheduled_id, "chatId": cid, "runAt": run_at, "messageIds": [], "status": "claimed", "claimedAt": now, "claimedBy": WORKER_ID}
+            for cid in chat_ids
+        ],
+        stale_before=now - lease,
+    )
 
-    for cid in chat_ids:
+    peers = await resolve_peers(client, [claim["chatId"] for claim in claimed])
+    album_lock = asyncio.Lock()
+
+    async def _album() -> List[Any]:
+        nonlocal album
+        async with album_lock:
+            if album is None:
+                album = await _prepare_album(client, image_urls)
+        return album
+
+    # Independent chats are sent concurrently; throttle() paces each chat and
+    # the account as a whole, the semaphore bounds in-flight requests.
+    sem = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+    results: List[UpdateOne] = []
+
+    async def _one(claim: Dict[str, Any]) -> None:
+        cid = claim["chatId"]
+        async with sem:
+            try:
+                if image_urls:
+                    msg_ids = await send_album_safe(client, cid, await _album(), image_urls, caption=caption, parse_mode=parse_mode or "html", min_delay_seconds=settings.MIN_DELAY_SECONDS, peer=peers[cid])
+                else:
+                    msg_ids = await send_text_safe(client, cid, caption, parse_mode=parse_mode or "html", link_preview=not disable_preview, min_delay_seconds=settings.MIN_DELAY_SECONDS, peer=peers[cid])
+                results.append(
+                    UpdateOne(
+                        {"_id": claim["_id"]},
+                        {"$set": {"messageIds": msg_ids, "status": "sent", "sentAt": datetime.now(timezone.utc)}},
+                    )
+                )
+            except Exception as e:
+                # The error is stored on the delivery row; logs only get a per-minute summary.
+                _delivery_errors[type(e).__name__] += 1
+                if settings.DEBUG:
+                    log.exception("Delivery failed scheduled=%s chat=%s", scheduled_id, cid)
+                results.append(
+                    UpdateOne(
+                        {"_id": claim["_id"]},
+                        {"$set": {"status": "error", "error": str(e), "sentAt": datetime.now(timezone.utc)}},
+                    )
+                )
+
+    async def _flush() -> None:
+        ops = results[:]
+        del results[:]
+        if not ops:
+            return
         try:
-            # skip if already delivered
-            if deliveries_coll.find_one({"scheduledId": scheduled_id, "chatId": cid, "runAt": run_at}):
-                continue
+            await deliveries_coll.bulk_write(ops, ordered=False)
+        except Exception:
+            results[:0] = ops  # keep them for the next flush
+            raise
+
+    async def _flush_periodically() -> None:
+        # Write outcomes as they come in, so a crash mid-run leaves only the
+        # unsent chats "claimed"; also renew both leases while we're alive, so
+        # a long fan-out isn't reaped and re-sent by another worker.
+        renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(_DELIVERY_FLUSH_SECONDS)
+            try:
+                await _flush()
+                if time.monotonic() - renewed >= lease.total_seconds() / 3:
+                    renewed = time.monotonic()
+                    await renew_claims(scheduled_coll, deliveries_coll, scheduled_id, run_at, datetime.now(timezone.utc))
+            except Exception as e:
+                log.warning("Delivery flush failed scheduled=%s: %s", scheduled_id, e)
+
+    flusher = asyncio.create_task(_flush_periodically())
+    try:
+        await asyncio.gather(*(_one(claim) for claim in claimed))
+    finally:
+        flusher.cancel()
+        await _flush()
+
+
+async def renew_claims(scheduled_coll, deliveries_coll, scheduled_id: Any, run_at: datetime, now: datetime) -> None:
+    """Extend this worker's lease on a message and its still-pending deliveries."""
+    await scheduled_coll.update_one(
+        {"_id": scheduled_id, "status": STATUS_PROCESSING, "claimedBy": WORKER_ID},
+        {"$set": {"claimedAt": now}},
+    )
+    await deliveries_coll.update_many(
+        {"scheduledId": scheduled_id, "runAt": run_at, "status": "claimed", "claimedBy": WORKER_ID},
+        {"$set": {"claimedAt": now}},
+    )
+
+
+async def claim_deliveries(
+    deliveries_coll, docs: List[Dict[str, Any]], stale_before: Optional[datetime] = None
+) -> List[Dict[str, Any]]:
+    """Insert delivery claim rows in one round trip; return the ones we now own.
 
-            if image_urls:
-                msg_ids = await send_images_safe(client, cid, [str(u) for u in image_urls], caption=caption, parse_mode=parse_mode or "html", min_delay_seconds=settings.MIN_DELAY_SECONDS)
+    Duplicate-key rejections mean the chat was already claimed for this run.
+    Rows still "claimed" from before stale_before belong to an attempt that
+    died mid-send; those are taken over instead of skipped.
+    """
+    if not docs:
+        return []
+    try:
+        await deliveries_coll.insert_many(docs, ordered=False)
+        return docs
+    except BulkWriteError as bwe:
+        rejected = set()
+        duplicates = []
+        for err in bwe.details.get("writeErrors", []):
+            rejected.add(err["index"])
+            if err.get("code") == 11000:
+                duplicates.append(docs[err["index"]])
             else:
-                msg_ids = await send_text_safe(client, cid, caption, parse_mode=parse_mode or "html", link_preview=not disable_preview, min_delay_seconds=settings.MIN_DELAY_SECONDS)
-
-            deliveries_coll.insert_one(
-                {
-                    "scheduledId": scheduled_id,
-                    "chatId": cid,
-                    "runAt": run_at,
-                    "messageIds": msg_ids,
-                    "status": "sent",
-                    "sentAt": datetime.now(timezone.utc),
-                }
-            )
-        except DuplicateKeyError:
-            continue
+                log.warning("Delivery claim failed chat=%s: %s", docs[err["index"]]["chatId"], err.get("errmsg"))
+        owned = [d for i, d in enumerate(docs) if i not in rejected]
+        if duplicates and stale_before is not None:
+            owned += await _take_stale_claims(deliveries_coll, duplicates, stale_before)
+        return owned
+
+
+async def _take_stale_claims(deliveries_coll, docs: List[Dict[str, Any]], stale_before: datetime) -> List[Dict[str, Any]]:
+    """Re-stamp expired "claimed" rows for docs (one scheduledId/runAt) and
+    return those docs carrying the existing rows' _id."""
+    first = docs[0]
+    by_chat = {d["chatId"]: d for d in docs}
+    match = {"scheduledId": first["scheduledId"], "runAt": first["runAt"], "chatId": {"$in": list(by_chat)}, "status": "claimed"}
+    # The lease check and re-stamp are one conditional update, so only one
+    # worker can take a stale row; the find then reads back which ones we got.
+    res = await deliveries_coll.update_many(
+        {**match, "claimedAt": {"$lt": stale_before}},
+        {"$set": {"claimedAt": first["claimedAt"], "claimedBy": WORKER_ID}},
+    )
+    if not res.modified_count:
+        return []
+    log.warning("Taking over %d stale delivery claims for scheduled=%s", res.modified_count, first["scheduledId"])
+    cur = deliveries_coll.find({**match, "claimedAt": first["claimedAt"], "claimedBy": WORKER_ID}, {"chatId": 1})
+    return [{**by_chat[d["chatId"]], "_id": d["_id"]} async for d in cur]
+
+
+# How often a fan-out writes finished deliveries back (and checks its leases).
+_DELIVERY_FLUSH_SECONDS = 5.0
+
+# Identifies this process in claimedBy so stuck claims can be traced.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+# Only the fields the scheduler and the send path read; skips bookkeeping
+# such as createdAt, idempotencyKey and past errors.
+_CLAIM_PROJECTION = {
+    "title": 1,
+    "description": 1,
+    "imageUrls": 1,
+    "targetsMode": 1,
+    "targetChatIds": 1,
+    "parseMode": 1,
+    "disablePreview": 1,
+    "scheduleType": 1,
+    "runAt": 1,
+    "cron": 1,
+    "endAt": 1,
+    "tz": 1,
+    "nextRunAt": 1,
+}
+
+
+async def claim_due_message(scheduled_coll, now: datetime) -> Optional[Dict[str, Any]]:
+    """Atomically move the oldest due message to "processing" and return it.
+
+    A single findAndModify, so two workers can never claim the same run.
+    """
+    return await scheduled_coll.find_one_and_update(
+        {
+            "enabled": True,
+            "status": {"$in": [STATUS_SCHEDULED, None]},
+            "nextRunAt": {"$lte": now},
+        },
+        {
+            "$set": {
+                "status": STATUS_PROCESSING,
+                "claimedBy": WORKER_ID,
+                "claimedAt": now,
+                "lastRunAt": now,
+                "updatedAt": now,
+            }
+        },
+        sort=[("nextRunAt", ASCENDING)],
+        projection=_CLAIM_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def reap_expired_claims(scheduled_coll, cutoff: datetime) -> None:
+    """Re-open claims whose worker died before finishing (lease expired)."""
+    res = await scheduled_coll.update_many(
+        {
+            "status": STATUS_PROCESSING,
+            "$or": [{"claimedAt": {"$lt": cutoff}}, {"claimedAt": {"$exists": False}}],
+        },
+        {"$set": {"status": STATUS_SCHEDULED}, "$unset": {"claimedBy": "", "claimedAt": ""}},
+    )
+    if res.modified_count:
+        log.warning("Re-opened %d scheduled messages with expired claims.", res.modified_count)
+
+
+async def watch_scheduled(scheduled_coll, wake: asyncio.Event) -> None:
+    """Set `wake` whenever a message is inserted or re-armed as scheduled.
+
+    Change streams need a replica set; on a standalone server this logs once
+    and the scheduler falls back to its poll interval.
+    """
+    pipeline = [
+        {
+            "$match": {
+                "operationType": {"$in": ["insert", "update", "replace"]},
+                "fullDocument.status": STATUS_SCHEDULED,
+            }
+        }
+    ]
+
+    while True:
+        try:
+            async with scheduled_coll.watch(pipeline, full_document="updateLookup") as stream:
+                async for _ in stream:
+                    wake.set()
+        except OperationFailure as e:
+            log.warning("Change stream unavailable, polling only: %s", e)
+            return
         except Exception as e:
-            log.warning("Delivery failed scheduled=%s chat=%s: %s", scheduled_id, cid, e)
-            try:
-                deliveries_coll.insert_one(
-                    {
-                        "scheduledId": scheduled_id,
-                        "chatId": cid,
-                        "runAt": run_at,
-                        "messageIds": [],
-                        "status": "error",
-                        "error": str(e),
-                        "sentAt": datetime.now(timezone.utc),
-                    }
-                )
-            except DuplicateKeyError:
-                pass
+            log.warning("Change stream error: %s", e)
+            await asyncio.sleep(5)
+
+
+async def next_due_at(scheduled_coll) -> Optional[datetime]:
+    """nextRunAt of the earliest scheduled message (read from due_1), or None."""
+    doc = await scheduled_coll.find_one(
+        {"enabled": True, "status": {"$in": [STATUS_SCHEDULED, None]}, "nextRunAt": {"$type": "date"}},
+        {"_id": 0, "nextRunAt": 1},
+        sort=[("nextRunAt", ASCENDING)],
+    )
+    if doc is None:
+        return None
+    next_at = doc["nextRunAt"]
+    # the client isn't tz_aware, so dates come back naive UTC
+    return next_at if next_at.tzinfo else next_at.replace(tzinfo=timezone.utc)
+
+
+async def _idle_seconds(scheduled_coll, settings, watching: bool) -> float:
+    """How long the scheduler may sleep: until the next known fire, capped by
+    the poll interval, or by SCHEDULER_MAX_IDLE_SECONDS while the change
+    stream is up to report anything new."""
+    cap = settings.SCHEDULER_MAX_IDLE_SECONDS if watching else settings.SCHEDULER_POLL_SECONDS
+    try:
+        next_at = await next_due_at(scheduled_coll)
+    except Exception as e:
+        log.warning("Could not read next due time: %s", e)
+        return settings.SCHEDULER_POLL_SECONDS
+    if next_at is None:
+        return cap
+    return min(cap, max(0.0, (next_at - datetime.now(timezone.utc)).total_seconds()))
 
 
 async def scheduler_loop(client: TelegramClient, db, settings):
     scheduled_coll = db[settings.SCHEDULED_MESSAGES_COLLECTION]
+    wake = asyncio.Event()
+    watch_task = asyncio.create_task(watch_scheduled(scheduled_coll, wake))
 
     log.info("Scheduler loop started.")
     while True:
+        failed = False
         try:
             now = datetime.now(timezone.utc)
-            cur = (
-                scheduled_coll.find(
-                    {
-                        "enabled": True,
-                        "status": {"$in": ["scheduled", "processing", None]},
-                        "nextRunAt": {"$lte": now},
-                    }
-                )
-                .sort("nextRunAt", 1)
-                .limit(25)
-            )
-
-            for doc in cur:
+            await reap_expired_claims(scheduled_coll, now - timedelta(minutes=settings.CLAIM_LEASE_MINUTES))
+
+            # Drain as much of the backlog as fits in the tick budget.
+            tick_start = time.monotonic()
+            while time.monotonic() - tick_start < settings.SCHEDULER_TICK_BUDGET_SECONDS:
+                # one timestamp per message: claim, claimedAt of its deliveries
+                now = datetime.now(timezone.utc)
+                doc = await claim_due_message(scheduled_coll, now)
+                if doc is None:
+                    break
                 scheduled_id = doc["_id"]
 
                 tz_name = doc.get("tz") or settings.TZ_NAME
                 try:
-                    tz = ZoneInfo(tz_name)
+                    tz = get_zone(tz_name)
                 except Exception:
                     tz = settings.tz
 
-                # Use the scheduled due time as the runAt key (idempotency for cron repeats)
+                # Use the scheduled due time as the runAt key (idempotency for cron repeats).
+                # nextRunAt is always a BSON date here (see normalize_schedule_dates).
                 run_at = doc.get("nextRunAt") or now
-                if isinstance(run_at, str):
-                    try:
-                        run_at = datetime.fromisoformat(run_at)
-                    except Exception:
-                        run_at = now
-                # mark processing
-                scheduled_coll.update_one(
-                    {"_id": scheduled_id},
-                    {"$set": {"status": "processing", "lastRunAt": now, "updatedAt": now}},
-                )
 
-                await send_scheduled_to_targets(client, db, settings, doc, run_at)
+                await send_scheduled_to_targets(client, db, settings, doc, run_at, now)
 
+                finished = datetime.now(timezone.utc)
                 schedule_type = doc.get("scheduleType", "once")
                 if schedule_type == "once":
-                    scheduled_coll.update_one(
+                    await scheduled_coll.update_one(
                         {"_id": scheduled_id},
-                        {"$set": {"status": "done", "enabled": False, "updatedAt": datetime.now(timezone.utc)}},
+                        {"$set": {"status": STATUS_DONE, "enabled": False, "updatedAt": finished}},
                     )
                 else:
                     try:
-                        next_run = compute_next_run_at_utc(doc, tz)
+                        next_run = compute_next_run_at_utc(doc, tz, finished)
                         if next_run is None:
-                            scheduled_coll.update_one(
+                            await scheduled_coll.update_one(
                                 {"_id": scheduled_id},
-                                {"$set": {"status": "ended", "enabled": False, "nextRunAt": None, "updatedAt": datetime.now(timezone.utc)}},
+                                {"$set": {"status": STATUS_ENDED, "enabled": False, "nextRunAt": None, "updatedAt": finished}},
                             )
                         else:
-                            scheduled_coll.update_one(
+                            await scheduled_coll.update_one(
                                 {"_id": scheduled_id},
-                                {"$set": {"status": "scheduled", "nextRunAt": next_run, "updatedAt": datetime.now(timezone.utc)}},
+                                {"$set": {"status": STATUS_SCHEDULED, "nextRunAt": next_run, "updatedAt": finished}},
                             )
                     except Exception as e:
-                        scheduled_coll.update_one(
+                        await scheduled_coll.update_one(
                             {"_id": scheduled_id},
-                            {"$set": {"status": "error", "enabled": False, "error": str(e), "updatedAt": datetime.now(timezone.utc)}},
+                            {"$set": {"status": STATUS_ERROR, "enabled": False, "error": str(e), "updatedAt": finished}},
                         )
         except Exception as e:
             log.error("Scheduler loop error: %s", e)
+            failed = True
 
-        await asyncio.sleep(settings.SCHEDULER_POLL_SECONDS)
+        # Sleep until the next message is due, or until the change stream
+        # reports new work. After an error, back off for a full poll interval.
+        if failed:
+            timeout = settings.SCHEDULER_POLL_SECONDS
+        else:
+            timeout = await _idle_seconds(scheduled_coll, settings, watching=not watch_task.done())
+        try:
+            await asyncio.wait_for(wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
 
 
 async def main():
     load_dotenv()
     settings = load_settings()
-    db = get_db(settings)
+    set_account_rate(settings.ACCOUNT_SENDS_PER_SECOND)
+    set_image_cache_dir(settings.IMAGE_CACHE_DIR)
+    db = await get_db(settings)
     chats_coll = db[settings.CHATS_COLLECTION]
 
     client = TelegramClient(StringSession(settings.STRING_SESSION), settings.API_ID, settings.API_HASH)
@@ -509,6 +1194,7 @@ async def main():
     # Background tasks
     asyncio.create_task(periodic_dialog_sync(client, chats_coll, settings.DIALOG_SYNC_EVERY_MINUTES))
     asyncio.create_task(scheduler_loop(client, db, settings))
+    asyncio.create_task(periodic_error_summary())
 
     # Lightweight discovery on incoming group messages
     @client.on(events.NewMessage)
@@ -521,7 +1207,7 @@ async def main():
             return
         title = getattr(ent, "title", getattr(ent, "username", None))
         norm = normalize_title(title)
-        now = datetime.now(timezone.utc)
+        now = _ts_for_minute(int(time.time()) // 60)
 
         base = {
             "chatId": chat_id,
@@ -534,19 +1220,22 @@ async def main():
         }
 
         if norm:
-            existing = chats_coll.find_one({"normalizedTitle": norm})
+            existing = await chats_coll.find_one({"normalizedTitle": norm}, {"_id": 1})
             if existing:
-                chats_coll.update_one({"_id": existing["_id"]}, {"$set": {"lastSeenAt": now, "isActive": True, "chatId": chat_id}})
+                await chats_coll.update_one({"_id": existing["_id"]}, {"$set": {"lastSeenAt": now, "isActive": True, "chatId": chat_id}})
                 return
 
-        chats_coll.update_one(
+        await chats_coll.update_one(
             {"chatId": chat_id},
             {"$setOnInsert": base, "$set": {"lastSeenAt": now, "isActive": True}},
             upsert=True,
         )
 
     log.info("Worker running.")
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        await _close_http_session()
 
 
 if __name__ == "__main__":